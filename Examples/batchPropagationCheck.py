@@ -0,0 +1,60 @@
+"""
+Check that the batch propagation (batchRayPropagator / propagateRays) in float64 reproduces
+rayPropagator.propagateRay ray by ray, over random rays which include clipped, missed and
+totally internally reflected rays.
+
+Usage (from the repository root):
+    python Examples/batchPropagationCheck.py
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Src import *
+
+tolerance = 1e-8
+nRays     = 3000
+
+systems = [ # Lens: (r_x, r_y, y_min, y_max), d, n, (r_x, r_y, y_min, y_max), x_l; Final Surface: (r_x, r_y, x, y_min, y_max), n, [y_min, y_max]
+            { 'lens_parameters': [ [ ( -50.0, 25.0, -5, 5 ), 5, 1.98, ( 100.0, 25.0, -5, 5 ), -30 ],
+                                   [ ( -50.0, 25.0, -5, 5 ), 5, 1.98, ( 100.0, 25.0, -5, 5 ), -22 ],
+                                   [ (  80.0, 25.0, -5, 5 ), 0.5, 1.98, ( -80.0, 25.0, -5, 5 ), -19 ],
+                                   [ (  80.0, 25.0, -5, 5 ), 0.5, 1.98, ( -80.0, 25.0, -5, 5 ), -11 ],
+                                   [ ( 1e-5, 5, 0, -5, 5 ), 1.69, [ -200, 100 ] ] ],
+              'yLimits': [ -200, 100 ], 'x': -45.0, 'y': 5.0, 'theta': 0.3 },
+            { 'lens_parameters': [ [ ( 3.0, 1.0, -0.9, 0.9 ), 4.0, 1.5, ( -3.0, 1.0, -0.9, 0.9 ), 5 ],
+                                   [ ( 3.0, 1.0, -0.9, 0.9 ), 4.0, 0.7, ( -3.0, 1.0, -0.9, 0.9 ), 20 ],   # n < 1 for total internal reflection
+                                   [ ( 1e-2, 1.3, 40.0, -0.9, 0.9 ), 1, [ -1.5, 1.5 ] ] ],
+              'yLimits': [ -1.5, 1.5 ], 'x': 0.0, 'y': 1.2, 'theta': 0.6 } ]
+
+def propagateRays_scalar(OS, rays, yLimits, nSurfacesPropagate, paraxial):
+    steps = []
+    for x, y, theta in rays:
+        propagator = rayPropagator(OS, opticalRay(x, y, theta), yLimits)
+        steps.append([(step.x, step.y, step.theta) for step in propagator.propagateRay(nSurfacesPropagate, paraxial)])
+    return np.array(steps)
+
+rng = np.random.default_rng(0)
+statusesSeen = set()
+for system in systems:
+    surfaces, lenses, OS = constructOpticalSystem(system['lens_parameters'])
+    rays = np.c_[np.full(nRays, system['x']),
+                 rng.uniform(-system['y'], system['y'], nRays),
+                 rng.uniform(-system['theta'], system['theta'], nRays) % (2*np.pi)]
+
+    for nSurfacesPropagate, paraxial in [(-1, False), (2, False), (-1, True)]:
+        with np.errstate(divide='ignore'):
+            steps_scalar = propagateRays_scalar(OS, rays, system['yLimits'], nSurfacesPropagate, paraxial)
+        steps, statuses = batchRayPropagator(OS, rays, system['yLimits']).propagateRays(nSurfacesPropagate, paraxial)
+        statusesSeen.update(np.unique(statuses).tolist())
+
+        deviation = np.abs(steps - steps_scalar).max()
+        print('nSurfaces =', len(OS.surfaces), '| nSurfacesPropagate =', nSurfacesPropagate, '| paraxial =', paraxial,
+              '| max deviation =', deviation, '| statuses:', {RAYSTATUS_NAMES[status]: int(np.count_nonzero(statuses[:,-1] == status)) for status in RAYSTATUS_NAMES})
+        assert steps.shape == steps_scalar.shape, 'batch and scalar propagation return different numbers of steps'
+        assert deviation < tolerance, 'batch propagation deviates from rayPropagator.propagateRay'
+        assert np.array_equal(steps[:,:,2] < 0, steps_scalar[:,:,2] < 0), 'batch and scalar propagation stop different rays'
+
+assert statusesSeen == set(RAYSTATUS_NAMES), 'not every ray status was exercised: '+str(statusesSeen)
+print('Batch propagation matches rayPropagator.propagateRay')
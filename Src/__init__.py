@@ -3,4 +3,5 @@ from .surface           import *
 from .lens              import *
 from .opticalSystem     import *
 from .opticalRay        import *
-from .rayPropagator     import *
\ No newline at end of file
+from .rayPropagator     import *
+from .traceServer       import *
\ No newline at end of file
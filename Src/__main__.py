@@ -0,0 +1,11 @@
+import argparse
+from .traceServer import serveTraces
+
+parser = argparse.ArgumentParser(description='Serve optical ray traces over a Unix socket.')
+parser.add_argument('socketPath')
+parser.add_argument('--maxBatchDelay' , type=float, default=2e-3)
+parser.add_argument('--maxBatchRays'  , type=int  , default=65536)
+parser.add_argument('--maxMessageSize', type=int  , default=1 << 28)
+parser.add_argument('--verbose'       , action='store_true')
+arguments = parser.parse_args()
+serveTraces(arguments.socketPath, arguments.maxBatchDelay, arguments.maxBatchRays, arguments.maxMessageSize, arguments.verbose)
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def quadraticFormula(sign, c_1, c_2, c_3, verbos=False):
     """
@@ -49,4 +50,27 @@ def limitAngle(angle, lower=0, upper=2*math.pi, verbos=False):
     while angle > upper:
         angle = angle - 2*math.pi
         
-    return angle
\ No newline at end of file
+    return angle
+
+def limitAngles(angles, lower=0, upper=2*math.pi):
+    """
+    Limits an array of angles within a specified range, element-wise equivalent to limitAngle.
+    
+    Parameters:
+        angles (numpy.ndarray): The angles to be limited.
+        lower (float, optional): The lower limit for the angles. Default is `0`.
+        upper (float, optional): The upper limit for the angles. Default is `2*math.pi`.
+    
+    Returns:
+        numpy.ndarray: The limited angle values, with the same dtype as angles.
+    
+    Raises:
+        ValueError: If the upper limit is not greater than the lower limit.
+    """
+    if lower >= upper:
+        raise ValueError('upper must be > than lower')
+    
+    angles = np.where(angles < lower, angles + 2*math.pi*np.ceil((lower - angles)/(2*math.pi)), angles)
+    angles = np.where(angles > upper, angles - 2*math.pi*np.ceil((angles - upper)/(2*math.pi)), angles)
+    
+    return angles
@@ -1,4 +1,5 @@
 from .misc import limitAngle
+import numpy as np
 import math
 
 class opticalRay:
@@ -58,4 +59,23 @@ class opticalRay:
 
         return True
 
+def opticalRaysToArray(opticalRays):
+    """
+    Convert optical rays to an array of ray states.
+
+    Parameters:
+        opticalRays (list or array): List of opticalRay objects or array-like of (x, y, theta) rows.
+
+    Returns:
+        numpy.ndarray: Array of shape (nRays, 3) with the (x, y, theta) state of each ray.
+    """
+    if not isinstance(opticalRays, np.ndarray):
+        opticalRays = list(opticalRays)
+    if len(opticalRays) > 0 and isinstance(opticalRays[0], opticalRay):
+        opticalRays = [(ray.x, ray.y, ray.theta) for ray in opticalRays]
+
+    rays = np.array(opticalRays, dtype=float).reshape(-1, 3)
+
+    return rays
+
 # def plotOpticalRay():
\ No newline at end of file
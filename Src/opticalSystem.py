@@ -172,6 +172,39 @@ class opticalSystem:
             
         return points
     
+    def get_description(self):
+        """
+        Get a plain description of the optical system, suitable for serialization.
+        
+        Returns:
+            dict: Dictionary with the surface parameters (r_x, r_y, x, y_min, y_max) and refractive index of each lens,
+                  the final surface parameters and the refractive index surrounding the lenses.
+        """
+        def surfaceParameters(surface):
+            return [float(surface.r_x), float(surface.r_y), float(surface.x), float(surface.y_min), float(surface.y_max)]
+        
+        return {'lenses'         : [[surfaceParameters(lens.surface_1), surfaceParameters(lens.surface_2), float(lens.refractiveIndex)]
+                                    for lens in self.lenses],
+                'finalSurface'   : surfaceParameters(self.finalSurface),
+                'refractiveIndex': float(self.refractiveIndices[0])}
+    
+def opticalSystemFromDescription(description, verbose=False):
+    """
+    Construct the optical system from a description returned by opticalSystem.get_description.
+    
+    Parameters:
+        description (dict): Description of the optical system.
+        verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+    
+    Returns:
+        opticalSystem: The reconstructed optical system.
+    """
+    lenses = []
+    for surface_1, surface_2, refractiveIndex in description['lenses']:
+        lenses.append(lens(surface(*surface_1,verbose=verbose),surface(*surface_2,verbose=verbose),refractiveIndex,verbose))
+    finalSurface = surface(*description['finalSurface'],verbose=verbose)
+    return opticalSystem(lenses,finalSurface,description['refractiveIndex'],verbose)
+    
 def constructOpticalSystem(lens_parameters, verbose=False):
     """
     Construct the optical system from the specified parameters.
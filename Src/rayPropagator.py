@@ -1,7 +1,11 @@
 import copy
 import math
+import numpy as np
 from .misc import quadraticFormula
 from .misc import limitAngle
+from .misc import limitAngles
+from .opticalRay import opticalRay
+from .opticalRay import opticalRaysToArray
 
 class rayPropagator:
     def __init__(self, opticalSystem, opticalRay, yLimits=None, verbose=False):
@@ -160,4 +164,288 @@ class rayPropagator:
                 
         opticalRay_temp.update_theta(theta_f)
         
-        return opticalRay_temp
\ No newline at end of file
+        return opticalRay_temp
+
+def get_nSteps(opticalSystem, nSurfacesPropagate=-1):
+    """
+    Get the number of ray states returned when propagating a ray through the optical system.
+
+    Parameters:
+        opticalSystem (opticalSystem): The optical system through which the ray is propagated.
+        nSurfacesPropagate (int, optional): Number of surfaces to propagate the ray. Default is -1, which means propagate through all surfaces.
+
+    Returns:
+        int: Number of ray states (the initial state plus one state per propagation step).
+    """
+    nSurfaces = len(opticalSystem.surfaces)
+    if nSurfacesPropagate > nSurfaces or nSurfacesPropagate <= 0:
+        return nSurfaces + 1
+    return 2 + min(nSurfaces - 1, nSurfacesPropagate)
+
+RAYSTATUS_ALIVE = 0
+RAYSTATUS_CLIP  = 1
+RAYSTATUS_MISS  = 2
+RAYSTATUS_TIR   = 3
+RAYSTATUS_NAMES = {RAYSTATUS_ALIVE: 'alive', RAYSTATUS_CLIP: 'clip', RAYSTATUS_MISS: 'miss', RAYSTATUS_TIR: 'TIR'}
+
+class batchRayPropagator:
+    def __init__(self, opticalSystem, opticalRays, yLimits=None, dtype=np.float64, verbose=False):
+        """
+        Initialize the batch ray propagator object with the specified parameters.
+
+        Parameters:
+            opticalSystem (opticalSystem): The optical system through which the rays will be propagated.
+            opticalRays (list or array): List of opticalRay objects or array-like of (x, y, theta) rows.
+            yLimits (list): y-limits for optical ray propagation.
+            dtype (numpy.dtype, optional): Precision of the ray states, np.float64 or np.float32. Default is np.float64.
+                                           Surface constants and the terms of the surface intersection and surface normal
+                                           which suffer from cancellation are always evaluated in float64.
+            verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+        """
+        self.opticalSystem = opticalSystem
+        self.yLimits       = yLimits
+        self.dtype         = np.dtype(dtype)
+        self.verbose       = verbose
+        if self.dtype not in [np.float32, np.float64]:
+            raise ValueError('dtype must be float32 or float64')
+
+        self.opticalRays = opticalRaysToArray(opticalRays).astype(self.dtype)
+        self.opticalRays[:,2] = limitAngles(self.opticalRays[:,2])
+        if np.any(np.cos(self.opticalRays[:,2]) <= 0):
+            raise ValueError('Theta out of bounds')
+        if np.any(self.opticalRays[:,0] > self.opticalSystem.surfaces[0].r_x + self.opticalSystem.surfaces[0].x):
+            raise ValueError("x-position of the optical ray is not less than all lenses' x-positions")
+
+        for lens in self.opticalSystem.lenses:
+            surface_1 = lens.surface_2
+            if yLimits != None and surface_1.y_min < yLimits[0]:
+                raise ValueError("Lens' y_min is lower than global y_min")
+            elif yLimits != None and surface_1.y_max > yLimits[1]:
+                raise ValueError("Lens' y_max is greater than global y_max")
+
+    def propagateRays(self,nSurfacesPropagate=-1,paraxial=False):
+        """
+        Propagate the optical rays through the optical system.
+        Equivalent to rayPropagator.propagateRay for each ray.
+
+        Parameters:
+            nSurfacesPropagate (int, optional): Number of surfaces to propagate the rays. Default is -1, which means propagate through all surfaces.
+            paraxial (bool, optional): True to use the paraxial appriximation to propagate the rays, False otherwise
+
+        Returns:
+            tuple: Array of shape (nRays, nSteps, 3) with the (x, y, theta) state of each ray at each step of propagation,
+                   and array of shape (nRays, nSteps) with the RAYSTATUS_* of each ray at each step of propagation.
+        """
+        surfaces          = self.opticalSystem.surfaces
+        refractiveIndices = self.opticalSystem.refractiveIndices
+        rays   = self.opticalRays.copy()
+        status = np.full(len(rays), RAYSTATUS_ALIVE, dtype=np.int8)
+        steps    = np.empty((len(rays), get_nSteps(self.opticalSystem, nSurfacesPropagate), 3), dtype=self.dtype)
+        statuses = np.empty(steps.shape[:2], dtype=np.int8)
+        steps[:,0], statuses[:,0] = rays, status
+
+        if nSurfacesPropagate > len(surfaces):
+            nSurfacesPropagate = -1
+
+        self.__translateRays(surfaces[0],rays,status,paraxial=paraxial)
+        steps[:,1], statuses[:,1] = rays, status
+        for nSurface in range(0,len(surfaces)-1):
+            if nSurfacesPropagate>0 and nSurface+1 > nSurfacesPropagate:
+                break
+
+            self.__refractRays(surfaces[nSurface],rays,status,refractiveIndices[nSurface],refractiveIndices[nSurface+1],paraxial=paraxial)
+            self.__translateRays(surfaces[nSurface+1],rays,status,paraxial=paraxial)
+            steps[:,nSurface+2], statuses[:,nSurface+2] = rays, status
+
+        return steps, statuses
+
+    def __translateRays(self,surface,rays,status,paraxial=False):
+        """
+        Translate the alive optical rays to the surface, in place.
+
+        Parameters:
+            surface (surface): The surface to which the rays are to be translated.
+            rays (numpy.ndarray): Array of shape (nRays, 3) with the (x, y, theta) state of each ray.
+            status (numpy.ndarray): Array of shape (nRays,) with the RAYSTATUS_* of each ray.
+        """
+        alive = np.flatnonzero(status == RAYSTATUS_ALIVE)
+        if paraxial or len(alive) == 0:
+            return
+
+        sign = +1 if surface.r_x > 0 else -1
+        x, y, theta = rays[alive].T.copy()
+
+        m = np.tan(theta)
+        m_64, x_64, y_64 = m.astype(np.float64), x.astype(np.float64), y.astype(np.float64)
+        c_1 = 1/surface.r_x**2 + m_64**2/surface.r_y**2
+        c_2 = -2*surface.x/surface.r_x**2 + m_64/surface.r_y**2 * (-2*m_64*x_64 + 2*y_64)
+        c_3 = surface.x**2/surface.r_x**2 + ((m_64*x_64 - y_64)/surface.r_y)**2 - 1
+
+        theta[theta == 0] = 1e-5
+
+        num = c_2**2 - 4*c_1*c_3
+        hit = num >= 0
+        x_new = ((-c_2 + sign*np.sqrt(np.where(hit, num, 0))) / (2*c_1)).astype(self.dtype)
+        y_new = m * (x_new - x) + y
+
+        below  = hit & (y_new < surface.y_min)
+        above  = hit & ~below & (y_new > surface.y_max)
+        inside = hit & ~below & ~above
+        miss   = ~hit
+        x[inside], y[inside] = x_new[inside], y_new[inside]
+
+        if self.yLimits == None:
+            if np.any(below | above):
+                raise ValueError('yLimits must be given to propagate rays outside of the surface y-limits')
+            if np.any(miss) and self.verbose:
+                print('WARNING: ray translated to invalid point')
+        else:
+            upper = above | (miss & (limitAngles(theta) < math.pi/2))
+            lower = below | (miss & ~upper)
+            for limit, mask in [(self.yLimits[0], lower), (self.yLimits[1], upper)]:
+                x[mask] = (limit-y[mask])/np.tan(theta[mask])+x[mask]
+                y[mask] = limit
+
+        theta[~inside] = -99999
+        rays[alive] = np.stack([x, y, theta], axis=-1)
+        status[alive[below | above]] = RAYSTATUS_CLIP
+        status[alive[miss]]          = RAYSTATUS_MISS
+
+    def __refractRays(self,surface,rays,status,refractiveIndex_i,refractiveIndex_f,paraxial=False):
+        """
+        Refract the alive optical rays at the surface, in place.
+
+        Parameters:
+            surface (surface): The surface at which the rays are to be refracted.
+            rays (numpy.ndarray): Array of shape (nRays, 3) with the (x, y, theta) state of each ray.
+            status (numpy.ndarray): Array of shape (nRays,) with the RAYSTATUS_* of each ray.
+            refractiveIndex_i (float): Refractive index of the medium from which the rays are incident.
+            refractiveIndex_f (float): Refractive index of the medium into which the rays are refracted.
+            paraxial (bool, optional): True if the rays were propagated with the paraxial appriximation, False otherwise
+        """
+        alive = np.flatnonzero(status == RAYSTATUS_ALIVE)
+        if len(alive) == 0:
+            return
+
+        x, y, theta = rays[alive].T
+        x_64, y_64 = x.astype(np.float64), y.astype(np.float64)
+        if self.dtype == np.float64 or paraxial:
+            num = surface.r_y**2/surface.r_x**2*(-x_64**2+2*surface.x*x_64-surface.x**2)+surface.r_y**2
+            if self.verbose and np.any(num <= 0):
+                print('WARNING: num<=0 for',np.count_nonzero(num <= 0),'rays')
+            num[num < 0]  = 0
+            num[num == 0] = 1e-25
+            dydx = surface.r_y**2/surface.r_x**2*(surface.x-x_64)*num**(-1/2)
+            dydx = np.where(y < 0, -dydx, dydx)
+        else:
+            # Near the vertex the slope from the x-position is ill-conditioned at float32 precision of x,
+            # so rays which were translated onto the surface use their y-position instead
+            with np.errstate(divide='ignore'):
+                dydx = surface.r_y**2/surface.r_x**2*(surface.x-x_64)/y_64
+
+        with np.errstate(divide='ignore'):
+            theta_n = np.arctan(-1/dydx).astype(self.dtype)
+
+        theta_in = limitAngles(theta,-math.pi/2,math.pi/2) - theta_n
+
+        tir = np.zeros(len(alive), dtype=bool)
+        if refractiveIndex_f <= refractiveIndex_i:
+            theta_c = limitAngle(math.asin(refractiveIndex_f/refractiveIndex_i))
+            tir = np.abs(theta_in) >= theta_c
+            if self.verbose and np.any(tir):
+                print('WARNING: total internal reflection for',np.count_nonzero(tir),'rays')
+
+        num2 = refractiveIndex_i/refractiveIndex_f*np.sin(theta_in[~tir])
+        if np.any(np.abs(num2)>1):
+            raise ValueError('WARNING: total internal reflection, |num2|>1:')
+
+        theta_f = limitAngles(theta_n[~tir]+np.arcsin(num2))
+        if np.any(np.cos(theta_f) <= 0):
+            raise ValueError('Theta out of bounds')
+
+        theta = theta.copy()
+        theta[~tir] = theta_f
+        theta[tir]  = -99999
+        rays[alive,2] = theta
+        status[alive[tir]] = RAYSTATUS_TIR
+
+def propagateRays(opticalSystem, opticalRays, yLimits=None, nSurfacesPropagate=-1, paraxial=False, dtype=np.float64, verbose=False):
+    """
+    Propagate a batch of optical rays through the optical system.
+
+    Parameters:
+        opticalSystem (opticalSystem): The optical system through which the rays will be propagated.
+        opticalRays (list or array): List of opticalRay objects or array-like of (x, y, theta) rows.
+        yLimits (list): y-limits for optical ray propagation.
+        nSurfacesPropagate (int, optional): Number of surfaces to propagate the rays. Default is -1, which means propagate through all surfaces.
+        paraxial (bool, optional): True to use the paraxial appriximation to propagate the rays, False otherwise
+        dtype (numpy.dtype, optional): Precision of the ray states, np.float64 or np.float32. Default is np.float64.
+                                       Use verifyPropagation to check whether np.float32 is accurate enough for the optical system.
+        verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+
+    Returns:
+        numpy.ndarray: Array of shape (nRays, nSteps, 3) with the (x, y, theta) state of each ray at each step of propagation.
+    """
+    steps, statuses = batchRayPropagator(opticalSystem, opticalRays, yLimits, dtype, verbose).propagateRays(nSurfacesPropagate, paraxial)
+
+    return steps
+
+def verifyPropagation(opticalSystem, opticalRays, yLimits=None, nSurfacesPropagate=-1, paraxial=False, dtype=np.float32,
+                      nSample=1000, tolerance_y=1e-3, tolerance_theta=1e-5, seed=None):
+    """
+    Verify a reduced precision propagation by retracing a random sample of the rays in float64.
+
+    Parameters:
+        opticalSystem (opticalSystem): The optical system through which the rays will be propagated.
+        opticalRays (list or array): List of opticalRay objects or array-like of (x, y, theta) rows.
+        yLimits (list): y-limits for optical ray propagation.
+        nSurfacesPropagate (int, optional): Number of surfaces to propagate the rays. Default is -1, which means propagate through all surfaces.
+        paraxial (bool, optional): True to use the paraxial appriximation to propagate the rays, False otherwise
+        dtype (numpy.dtype, optional): Precision to verify. Default is np.float32.
+        nSample (int, optional): Number of randomly sampled rays to retrace. Default is 1000.
+        tolerance_y (float, optional): Maximum allowed y deviation, in the units of the optical system. Default is 1e-3.
+        tolerance_theta (float, optional): Maximum allowed theta deviation (in radians). Default is 1e-5.
+        seed (int, optional): Seed of the random ray sample. Default is None.
+
+    Returns:
+        dict: Verification report with the maximum y and theta deviations over all surfaces ('maxDeviation_y', 'maxDeviation_theta'),
+              the number of rays whose status differs between dtype and float64 ('nStatusDisagreements'), whether the precision is
+              within the tolerances and without status disagreements ('safe'), and per surface ('surfaces', with the index into
+              opticalSystem.surfaces as 'surface') the maximum y and theta deviations of the rays at that surface and the number of
+              rays whose status first differs at that surface, by clip or miss when translated to it or TIR when refracted at it.
+              Deviations are only taken over rays with the same status in both precisions; theta only over alive rays.
+    """
+    rays   = opticalRaysToArray(opticalRays)
+    sample = np.random.default_rng(seed).choice(len(rays), size=min(nSample, len(rays)), replace=False)
+
+    steps, statuses       = batchRayPropagator(opticalSystem, rays[sample], yLimits, dtype).propagateRays(nSurfacesPropagate, paraxial)
+    steps_64, statuses_64 = batchRayPropagator(opticalSystem, rays[sample], yLimits, np.float64).propagateRays(nSurfacesPropagate, paraxial)
+    deviations = np.abs(steps.astype(np.float64) - steps_64)
+
+    disagree   = statuses != statuses_64
+
+    # Step nStep holds the rays translated to surfaces[nStep-1], after being refracted at surfaces[nStep-2]
+    report = {'dtype': np.dtype(dtype).name, 'nSample': len(sample), 'surfaces': []}
+    for nStep in range(1, steps.shape[1]):
+        agree = ~disagree[:,nStep]
+        alive = agree & (statuses_64[:,nStep] == RAYSTATUS_ALIVE)
+        report['surfaces'].append({'surface'             : nStep-1,
+                                   'maxDeviation_y'      : float(deviations[agree,nStep,1].max(initial=0)),
+                                   'maxDeviation_theta'  : float(deviations[alive,nStep,2].max(initial=0)),
+                                   'nStatusDisagreements': 0,
+                                   'statusDisagreements' : {RAYSTATUS_NAMES[rayStatus]: 0 for rayStatus in [RAYSTATUS_TIR, RAYSTATUS_CLIP, RAYSTATUS_MISS]}})
+
+    for nStep in range(1, steps.shape[1]):
+        first = disagree[:,nStep] & ~disagree[:,nStep-1]
+        tir   = first & ((statuses[:,nStep] == RAYSTATUS_TIR) | (statuses_64[:,nStep] == RAYSTATUS_TIR))
+        for surface, mask in [(report['surfaces'][max(nStep-2,0)], tir), (report['surfaces'][nStep-1], first & ~tir)]:
+            surface['nStatusDisagreements'] += int(np.count_nonzero(mask))
+            for rayStatus in [RAYSTATUS_TIR, RAYSTATUS_CLIP, RAYSTATUS_MISS]:
+                surface['statusDisagreements'][RAYSTATUS_NAMES[rayStatus]] += int(np.count_nonzero(mask & ((statuses[:,nStep] == rayStatus) | (statuses_64[:,nStep] == rayStatus))))
+
+    report['maxDeviation_y']       = max([surface['maxDeviation_y']     for surface in report['surfaces']], default=0.0)
+    report['maxDeviation_theta']   = max([surface['maxDeviation_theta'] for surface in report['surfaces']], default=0.0)
+    report['nStatusDisagreements'] = int(np.count_nonzero(np.any(disagree, axis=1)))
+    report['safe'] = report['maxDeviation_y'] <= tolerance_y and report['maxDeviation_theta'] <= tolerance_theta and report['nStatusDisagreements'] == 0
+
+    return report
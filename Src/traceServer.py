@@ -0,0 +1,457 @@
+import asyncio
+import hashlib
+import json
+import socket
+import struct
+import time
+from collections import deque
+import numpy as np
+from .opticalSystem import opticalSystemFromDescription
+from .opticalRay import opticalRaysToArray
+from .rayPropagator import propagateRays
+
+__all__ = ['traceServer', 'traceClient', 'serveTraces']
+
+# Wire format (all header fields big-endian, ray arrays little-endian float64, or float32 with FLAG_FLOAT32):
+#   request  : header (message type, payload length) + payload
+#   response : header (status, payload length) + payload
+#   REGISTER : JSON of opticalSystem.get_description()           -> 32 byte system hash
+#   TRACE    : system hash, flags, nSurfacesPropagate, nRays,
+#              y_min, y_max, nRays*3 ray states (x, y, theta)     -> nRays, nSteps, nRays*nSteps*3 ray states
+#   STATS    : empty                                              -> JSON of traceServer.get_stats()
+MESSAGE_REGISTER = 1
+MESSAGE_TRACE    = 2
+MESSAGE_STATS    = 3
+
+STATUS_OK            = 0
+STATUS_ERROR         = 1
+STATUS_UNKNOWNSYSTEM = 2
+
+FLAG_PARAXIAL = 1 << 0
+FLAG_YLIMITS  = 1 << 1
+FLAG_FLOAT32  = 1 << 2
+
+HEADER       = struct.Struct('!BI')
+TRACE_HEADER = struct.Struct('!32sBiIdd')
+TRACE_RESULT = struct.Struct('!II')
+RAY_DTYPES   = {np.dtype(np.float64): np.dtype('<f8'), np.dtype(np.float32): np.dtype('<f4')}
+
+def hashOpticalSystem(description):
+    """
+    Hash the description of an optical system.
+
+    Parameters:
+        description (dict): Description of the optical system, as returned by opticalSystem.get_description.
+
+    Returns:
+        bytes: 32 byte SHA-256 digest identifying the optical system.
+    """
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).digest()
+
+class traceServer:
+    def __init__(self, socketPath, maxBatchDelay=2e-3, maxBatchRays=65536, maxMessageSize=1 << 28, nLatencies=10000, verbose=False):
+        """
+        Initialize the trace server object with the specified parameters.
+
+        Parameters:
+            socketPath (str): Path of the Unix socket the server listens on.
+            maxBatchDelay (float, optional): Maximum time (in seconds) a request waits for other requests to be coalesced with. Default is 2e-3.
+            maxBatchRays (int, optional): Number of queued rays which triggers a trace without waiting for maxBatchDelay. Default is 65536.
+            maxMessageSize (int, optional): Maximum payload size (in bytes) of a request. Default is 1 << 28.
+            nLatencies (int, optional): Number of most recent request latencies used for the latency percentiles. Default is 10000.
+            verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+        """
+        self.socketPath     = socketPath
+        self.maxBatchDelay  = maxBatchDelay
+        self.maxBatchRays   = maxBatchRays
+        self.maxMessageSize = maxMessageSize
+        self.verbose        = verbose
+        self.opticalSystems = {}
+        self.latencies      = deque(maxlen=nLatencies)
+        self.nRequests      = 0
+        self.nBatches       = 0
+        self.nRaysTraced    = 0
+        self.__queue        = []
+        self.__nRaysQueued  = 0
+        self.__queueEvent   = None
+        self.__fullEvent    = None
+
+    async def serve(self):
+        """
+        Listen on the Unix socket and trace incoming requests until cancelled.
+        """
+        self.__queueEvent = asyncio.Event()
+        self.__fullEvent  = asyncio.Event()
+        batcher = asyncio.create_task(self.__batchRequests())
+        server  = await asyncio.start_unix_server(self.__handleConnection, path=self.socketPath)
+        if self.verbose:
+            print('Trace server listening on', self.socketPath)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def register(self, description):
+        """
+        Construct an optical system and keep it resident on the server.
+
+        Parameters:
+            description (dict): Description of the optical system, as returned by opticalSystem.get_description.
+
+        Returns:
+            bytes: 32 byte hash identifying the optical system in trace requests.
+        """
+        systemHash = hashOpticalSystem(description)
+        if systemHash not in self.opticalSystems:
+            self.opticalSystems[systemHash] = opticalSystemFromDescription(description)
+        return systemHash
+
+    def get_stats(self):
+        """
+        Get the queue depth, throughput counters and latency percentiles of the server.
+
+        Returns:
+            dict: Dictionary of server statistics. Latencies are in milliseconds.
+        """
+        latencies = np.array(self.latencies)*1e3
+        percentiles = {}
+        for percentile in [50, 90, 99]:
+            percentiles['p'+str(percentile)] = float(np.percentile(latencies, percentile)) if len(latencies) > 0 else None
+
+        return {'nOpticalSystems'   : len(self.opticalSystems),
+                'queueDepth'        : len(self.__queue),
+                'queueDepth_rays'   : self.__nRaysQueued,
+                'nRequests'         : self.nRequests,
+                'nBatches'          : self.nBatches,
+                'nRaysTraced'       : self.nRaysTraced,
+                'latency_ms'        : percentiles}
+
+    async def __handleConnection(self, reader, writer):
+        """
+        Read requests from a client connection and write back the responses.
+
+        Parameters:
+            reader (asyncio.StreamReader): Stream the requests are read from.
+            writer (asyncio.StreamWriter): Stream the responses are written to.
+        """
+        try:
+            while True:
+                try:
+                    messageType, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                    if length > self.maxMessageSize:
+                        # The rest of the stream cannot be trusted, so reply and close the connection
+                        response = ('Message of '+str(length)+' bytes exceeds maxMessageSize').encode()
+                        writer.write(HEADER.pack(STATUS_ERROR, len(response)) + response)
+                        await writer.drain()
+                        break
+                    payload = await reader.readexactly(length)
+                    status, response = await self.__handleMessage(messageType, payload)
+                    writer.write(HEADER.pack(status, len(response)) + response)
+                    await writer.drain()
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+        finally:
+            writer.close()
+
+    async def __handleMessage(self, messageType, payload):
+        """
+        Handle a single request.
+
+        Parameters:
+            messageType (int): Type of the request.
+            payload (bytes): Payload of the request.
+
+        Returns:
+            tuple: Response status and payload.
+        """
+        try:
+            if messageType == MESSAGE_REGISTER:
+                return STATUS_OK, self.register(json.loads(payload.decode()))
+            elif messageType == MESSAGE_STATS:
+                return STATUS_OK, json.dumps(self.get_stats()).encode()
+            elif messageType == MESSAGE_TRACE:
+                return await self.__handleTrace(payload)
+            raise ValueError('Unknown message type: '+str(messageType))
+        except Exception as error:
+            if self.verbose:
+                print('WARNING: request failed:', repr(error))
+            return STATUS_ERROR, repr(error).encode()
+
+    async def __handleTrace(self, payload):
+        """
+        Queue a trace request and wait until its batch has been traced.
+
+        Parameters:
+            payload (bytes): Payload of the trace request.
+
+        Returns:
+            tuple: Response status and payload.
+        """
+        time_start = time.perf_counter()
+        systemHash, flags, nSurfacesPropagate, nRays, y_min, y_max = TRACE_HEADER.unpack_from(payload)
+        if systemHash not in self.opticalSystems:
+            return STATUS_UNKNOWNSYSTEM, b''
+        dtype = np.dtype(np.float32 if flags & FLAG_FLOAT32 else np.float64)
+        rays  = np.frombuffer(payload, dtype=RAY_DTYPES[dtype], count=3*nRays, offset=TRACE_HEADER.size).reshape(nRays, 3)
+
+        yLimits = [y_min, y_max] if flags & FLAG_YLIMITS else None
+        key     = (systemHash, bool(flags & FLAG_PARAXIAL), nSurfacesPropagate, None if yLimits == None else tuple(yLimits), dtype)
+        future  = asyncio.get_running_loop().create_future()
+        self.__queue.append((key, rays, future))
+        self.__nRaysQueued += nRays
+        self.__queueEvent.set()
+        if self.__nRaysQueued >= self.maxBatchRays:
+            self.__fullEvent.set()
+
+        steps = await future
+        self.nRequests += 1
+        self.latencies.append(time.perf_counter() - time_start)
+
+        return STATUS_OK, TRACE_RESULT.pack(*steps.shape[:2]) + steps.astype(RAY_DTYPES[dtype]).tobytes()
+
+    async def __batchRequests(self):
+        """
+        Coalesce queued trace requests with the same optical system and options into single batch traces.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.__queueEvent.wait()
+            try:
+                await asyncio.wait_for(self.__fullEvent.wait(), timeout=self.maxBatchDelay)
+            except asyncio.TimeoutError:
+                pass
+            queue, self.__queue = self.__queue, []
+            self.__nRaysQueued = 0
+            self.__queueEvent.clear()
+            self.__fullEvent.clear()
+
+            batches = {}
+            for key, rays, future in queue:
+                batches.setdefault(key, []).append((rays, future))
+            for key, requests in batches.items():
+                results = await loop.run_in_executor(None, self.__traceBatch, key, [rays for rays, future in requests])
+                for (rays, future), result in zip(requests, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+    def __traceBatch(self, key, batch):
+        """
+        Trace the rays of several requests in a single call to propagateRays.
+
+        Parameters:
+            key (tuple): System hash, paraxial flag, nSurfacesPropagate, yLimits and dtype shared by the requests.
+            batch (list): List of (nRays, 3) ray arrays, one per request.
+
+        Returns:
+            list: Array of ray states (or the exception raised while tracing) for each request.
+        """
+        systemHash, paraxial, nSurfacesPropagate, yLimits, dtype = key
+        OS = self.opticalSystems[systemHash]
+        if yLimits != None:
+            yLimits = list(yLimits)
+
+        self.nBatches += 1
+        try:
+            steps = propagateRays(OS, np.concatenate(batch), yLimits, nSurfacesPropagate, paraxial, dtype)
+            self.nRaysTraced += len(steps)
+            return np.split(steps, np.cumsum([len(rays) for rays in batch])[:-1])
+        except Exception:
+            # Retrace the requests separately so that one invalid request does not fail the others
+            results = []
+            for rays in batch:
+                try:
+                    results.append(propagateRays(OS, rays, yLimits, nSurfacesPropagate, paraxial, dtype))
+                    self.nRaysTraced += len(rays)
+                except Exception as error:
+                    results.append(error)
+            return results
+
+def serveTraces(socketPath, maxBatchDelay=2e-3, maxBatchRays=65536, maxMessageSize=1 << 28, verbose=False):
+    """
+    Run a trace server on the Unix socket until interrupted.
+
+    Parameters:
+        socketPath (str): Path of the Unix socket the server listens on.
+        maxBatchDelay (float, optional): Maximum time (in seconds) a request waits for other requests to be coalesced with. Default is 2e-3.
+        maxBatchRays (int, optional): Number of queued rays which triggers a trace without waiting for maxBatchDelay. Default is 65536.
+        maxMessageSize (int, optional): Maximum payload size (in bytes) of a request. Default is 1 << 28.
+        verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+    """
+    server = traceServer(socketPath, maxBatchDelay, maxBatchRays, maxMessageSize, verbose=verbose)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+class traceClient:
+    def __init__(self, socketPath, verbose=False):
+        """
+        Initialize the trace client object with the specified parameters.
+
+        Parameters:
+            socketPath (str): Path of the Unix socket the trace server listens on.
+            verbose (bool, optional): Flag indicating whether to print verbose output. Default is False.
+        """
+        self.socketPath = socketPath
+        self.verbose    = verbose
+        self.__socket   = None
+        self.__registeredHashes = set()
+
+    def close(self):
+        """
+        Close the connection to the trace server.
+        """
+        if self.__socket != None:
+            self.__socket.close()
+            self.__socket = None
+        self.__registeredHashes = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def register(self, opticalSystem):
+        """
+        Send an optical system to the trace server so that it is kept resident.
+
+        Parameters:
+            opticalSystem (opticalSystem): The optical system to register.
+
+        Returns:
+            bytes: 32 byte hash identifying the optical system on the server.
+        """
+        systemHash = self.__request(MESSAGE_REGISTER, json.dumps(opticalSystem.get_description()).encode())
+        self.__registeredHashes.add(systemHash)
+        return systemHash
+
+    def get_stats(self):
+        """
+        Get the queue depth, throughput counters and latency percentiles of the trace server.
+
+        Returns:
+            dict: Dictionary of server statistics. Latencies are in milliseconds.
+        """
+        return json.loads(self.__request(MESSAGE_STATS, b'').decode())
+
+    def propagateRays(self, opticalSystem, opticalRays, yLimits=None, nSurfacesPropagate=-1, paraxial=False, dtype=np.float64):
+        """
+        Propagate a batch of optical rays through the optical system on the trace server.
+        Equivalent to the local propagateRays function.
+
+        Parameters:
+            opticalSystem (opticalSystem): The optical system through which the rays will be propagated.
+            opticalRays (list or array): List of opticalRay objects or array-like of (x, y, theta) rows.
+            yLimits (list): y-limits for optical ray propagation.
+            nSurfacesPropagate (int, optional): Number of surfaces to propagate the rays. Default is -1, which means propagate through all surfaces.
+            paraxial (bool, optional): True to use the paraxial appriximation to propagate the rays, False otherwise
+            dtype (numpy.dtype, optional): Precision of the ray states, np.float64 or np.float32. Default is np.float64.
+
+        Returns:
+            numpy.ndarray: Array of shape (nRays, nSteps, 3) with the (x, y, theta) state of each ray at each step of propagation.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in RAY_DTYPES:
+            raise ValueError('dtype must be float32 or float64')
+
+        systemHash = hashOpticalSystem(opticalSystem.get_description())
+        if systemHash not in self.__registeredHashes:
+            self.register(opticalSystem)
+
+        rays  = opticalRaysToArray(opticalRays)
+        flags = (FLAG_PARAXIAL if paraxial else 0) | (FLAG_YLIMITS if yLimits != None else 0) | (FLAG_FLOAT32 if dtype == np.float32 else 0)
+        y_min, y_max = yLimits if yLimits != None else (0, 0)
+        payload = TRACE_HEADER.pack(systemHash, flags, nSurfacesPropagate, len(rays), y_min, y_max) + rays.astype(RAY_DTYPES[dtype]).tobytes()
+
+        try:
+            response = self.__request(MESSAGE_TRACE, payload)
+        except KeyError:
+            # __request reconnected to a restarted server, which no longer knows the optical system
+            self.register(opticalSystem)
+            response = self.__request(MESSAGE_TRACE, payload)
+
+        nRays, nSteps = TRACE_RESULT.unpack_from(response)
+        steps = np.frombuffer(response, dtype=RAY_DTYPES[dtype], offset=TRACE_RESULT.size).reshape(nRays, nSteps, 3)
+
+        return steps.astype(dtype)
+
+    def __connect(self):
+        """
+        Connect to the trace server if not already connected.
+        """
+        if self.__socket == None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(self.socketPath)
+            except OSError:
+                connection.close()
+                raise
+            self.__socket = connection
+            self.__registeredHashes = set()
+
+    def __request(self, messageType, payload):
+        """
+        Send a request to the trace server and wait for its response.
+        If the connection was closed by the server, e.g. because it was restarted, reconnect once and resend the request.
+
+        Parameters:
+            messageType (int): Type of the request.
+            payload (bytes): Payload of the request.
+
+        Returns:
+            bytes: Payload of the response.
+
+        Raises:
+            KeyError: If the server does not know the optical system of a trace request.
+            ValueError: If the request failed on the server.
+        """
+        for nTry in range(2):
+            self.__connect()
+            try:
+                self.__socket.sendall(HEADER.pack(messageType, len(payload)) + payload)
+                status, length = HEADER.unpack(self.__receive(HEADER.size))
+                response = self.__receive(length)
+                break
+            except ConnectionError:
+                self.close()
+                if nTry > 0:
+                    raise
+            except OSError:
+                self.close()
+                raise
+
+        if status == STATUS_UNKNOWNSYSTEM:
+            self.__registeredHashes = set()
+            raise KeyError('Optical system is not registered on the trace server')
+        elif status != STATUS_OK:
+            raise ValueError('Trace server error: '+response.decode())
+
+        return response
+
+    def __receive(self, length):
+        """
+        Receive exactly length bytes from the trace server.
+
+        Parameters:
+            length (int): Number of bytes to receive.
+
+        Returns:
+            bytes: The received bytes.
+
+        Raises:
+            ConnectionError: If the server closed the connection.
+        """
+        chunks = []
+        while length > 0:
+            chunk = self.__socket.recv(min(length, 1 << 20))
+            if not chunk:
+                raise ConnectionError('Trace server closed the connection')
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)